@@ -1,13 +1,106 @@
 from fastapi import FastAPI, HTTPException, Query
 from typing import Optional, List, Dict, Any, Tuple
-from pydantic import BaseModel
-import uuid
-from azure.cosmos import CosmosClient, PartitionKey, DatabaseProxy
+from pydantic import BaseModel, Field
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import DatabaseProxy
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.core import MatchConditions
 from datetime import datetime
+import logging
 import random
+import asyncio
+import zlib
+import base64
+import binascii
+import hashlib
+import re
+import orjson
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 app = FastAPI()
 
+logger = logging.getLogger("dictionary")
+
+RANDOM_KEY_SPACE = 2 ** 32
+
+BATCH_CONCURRENCY = 64
+
+CACHE_MAXSIZE = 10_000
+CACHE_TTL = 60
+
+MAX_TOKEN_BYTES = 4096
+
+SEARCH_CACHE_PREFIX = "search:"
+SEARCH_CACHE_TTL = 300
+SEARCH_GENERATION_KEY = "search:gen"
+
+COUNT_KEY = "def:count"
+COUNT_RECONCILE_SECONDS = 3600
+COUNT_ADJUST_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return redis.call("INCRBY", KEYS[1], ARGV[1])
+end
+"""
+
+DEFINITION_FIELDS = "d.id, d.word, d.content, d.tag, d.abbreviation, d.author, d.created_date, d._etag"
+
+QUERY_ALL = f"SELECT {DEFINITION_FIELDS} FROM d"
+QUERY_BY_TAG = f"SELECT {DEFINITION_FIELDS} FROM d WHERE d.tag_lc = @tag"
+QUERY_BY_PREFIX = f"SELECT {DEFINITION_FIELDS} FROM d WHERE STARTSWITH(d.word_lc, @prefix)"
+QUERY_FULL_TEXT = (
+    f"SELECT {DEFINITION_FIELDS} FROM d WHERE "
+    "FullTextContainsAny(d.word, @term) OR "
+    "FullTextContainsAny(d.content, @term) OR "
+    "FullTextContainsAny(d.author.name, @term) OR "
+    "FullTextContainsAny(d.tag, @term) OR "
+    "FullTextContainsAny(d.abbreviation, @term) "
+    "ORDER BY RANK FullTextScore(d.content, @term)"
+)
+QUERY_LIKE = (
+    f"SELECT {DEFINITION_FIELDS} FROM d WHERE "
+    "LOWER(d.word) LIKE @search OR "
+    "LOWER(d.content) LIKE @search OR "
+    "LOWER(d.author.name) LIKE @search OR "
+    "LOWER(d.tag) LIKE @search OR "
+    "LOWER(d.abbreviation) LIKE @search"
+)
+QUERY_RANDOM = f"SELECT TOP 1 {DEFINITION_FIELDS} FROM d WHERE d.random_key >= @start ORDER BY d.random_key"
+QUERY_COUNT = "SELECT VALUE COUNT(1) FROM d"
+
+PARTITION_KEY_PATH = "/word_lc"
+
+FULL_TEXT_PATHS = ["/word", "/content", "/tag", "/abbreviation", "/author/name"]
+
+FULL_TEXT_POLICY = {
+    "defaultLanguage": "en-US",
+    "fullTextPaths": [{"path": path, "language": "en-US"} for path in FULL_TEXT_PATHS]
+}
+
+INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/word_lc/?"}, {"path": "/tag_lc/?"}, {"path": "/random_key/?"}],
+    "excludedPaths": [{"path": "/*"}],
+    "fullTextIndexes": [{"path": path} for path in FULL_TEXT_PATHS]
+}
+
+async def create_definitions_container(database: DatabaseProxy, definitions_container: str):
+    container = await database.create_container_if_not_exists(
+        id=definitions_container,
+        partition_key=PartitionKey(path=PARTITION_KEY_PATH),
+        indexing_policy=INDEXING_POLICY,
+        full_text_policy=FULL_TEXT_POLICY
+    )
+    properties = await container.read()
+    paths = properties.get("partitionKey", {}).get("paths", [])
+    if paths != [PARTITION_KEY_PATH]:
+        raise RuntimeError(
+            f"Container '{definitions_container}' is partitioned on {paths}, expected ['{PARTITION_KEY_PATH}']. "
+            "Re-create it and re-import the definitions before starting the service."
+        )
+    return container
+
 class Author(BaseModel):
     name: str
 
@@ -19,6 +112,7 @@ class Definition(BaseModel):
     abbreviation: str
     author: Author
     created_date: Optional[datetime] = None
+    etag: Optional[str] = Field(default=None, exclude=True)
 
 
 class PaginatedResponse(BaseModel):
@@ -26,86 +120,247 @@ class PaginatedResponse(BaseModel):
     continuation_token: Optional[str] = None
 
 class DefinitionsRepository:
-    def __init__(self, database: DatabaseProxy, definitions_container: str):
+    def __init__(self, database: DatabaseProxy, definitions_container: str, full_text_search: bool = True, redis: Optional[Redis] = None):
         self.definitions = database.get_container_client(definitions_container)
         self.max_page_size = 50
+        self.full_text_search = full_text_search
+        self.redis = redis
+        self._adjust_count_script = redis.register_script(COUNT_ADJUST_SCRIPT) if redis is not None else None
+        self.cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._generation = 0
 
     async def get_all_definitions(self, page_size: int = 10, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
-        page_size = min(page_size, self.max_page_size)
-        query = "SELECT * FROM c"
-        return await self._query_with_paging(query, page_size, continuation_token)
+        return await self._query_with_paging(QUERY_ALL, page_size, continuation_token)
 
     async def get_definition_by_id(self, id: str, word: str) -> Optional[Definition]:
         try:
-            result = self.definitions.read_item(id, partition_key=word)
-            return Definition(**result)
-        except:
+            result = await self.definitions.read_item(id, partition_key=word.lower())
+            return self._to_definition(result)
+        except CosmosResourceNotFoundError:
             return None
 
 
     async def get_definition_by_word(self, word: str) -> Optional[Definition]:
-        query = "SELECT * FROM d WHERE LOWER(d.word) = @word"
-        params = [{"name": "@word", "value": word.lower()}]
-        results = list(self.definitions.query_items(query, parameters=params))
-        return Definition(**results[0]) if results else None
+        word_lc = word.lower()
+        results = self.cache.get(self._cache_key("read_item", None, word_lc))
+        if results is None:
+            inflight = self._inflight.get(word_lc)
+            if inflight is None:
+                inflight = self._inflight[word_lc] = asyncio.ensure_future(self._read_word(word_lc))
+            results = await asyncio.shield(inflight)
+        return self._to_definition(results[0]) if results else None
+
+    async def _read_word(self, word_lc: str) -> List[Dict[str, Any]]:
+        task = asyncio.current_task()
+        try:
+            results = [await self.definitions.read_item(word_lc, partition_key=word_lc)]
+        except CosmosResourceNotFoundError:
+            results = []
+        finally:
+            current = self._inflight.get(word_lc) is task
+            if current:
+                del self._inflight[word_lc]
+        if current:
+            self.cache[self._cache_key("read_item", None, word_lc)] = results
+        return results
 
     async def get_definitions_by_tag(self, tag: str, page_size: int = 5, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
-        query = "SELECT * FROM d WHERE LOWER(d.tag) = @tag"
         params = [{"name": "@tag", "value": tag.lower()}]
-        return await self._query_with_paging(query, page_size, continuation_token, params)
+        return await self._query_with_paging(QUERY_BY_TAG, page_size, continuation_token, params)
+
+    async def get_definitions_by_prefix(self, prefix: str, page_size: int = 10, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
+        params = [{"name": "@prefix", "value": prefix.lower()}]
+        return await self._query_with_paging(QUERY_BY_PREFIX, page_size, continuation_token, params)
 
-    async def delete_definition(self, definition: Definition):
-        self.definitions.delete_item(definition.id, partition_key=definition.word)
+    async def delete_definition(self, word: str):
+        await self.definitions.delete_item(word.lower(), partition_key=word.lower())
+        await self._invalidate()
+        await self._adjust_count(-1)
 
     async def add_definition(self, definition: Definition):
-        definition.id = str(uuid.uuid4())
+        definition.id = definition.word.lower()
         definition.created_date = datetime.utcnow()
-        self.definitions.create_item(definition.dict())
+        await self.definitions.create_item(self._to_document(definition))
+        await self._invalidate()
+        await self._adjust_count(1)
+
+    async def add_definitions(self, definitions: List[Definition]):
+        documents = []
+        for definition in definitions:
+            definition.id = definition.word.lower()
+            definition.created_date = datetime.utcnow()
+            documents.append(self._to_document(definition))
+
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        results = await asyncio.gather(
+            *(self._create_bounded(semaphore, document) for document in documents),
+            return_exceptions=True
+        )
+        await self._invalidate()
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+
+    async def _create_bounded(self, semaphore: asyncio.Semaphore, document: Dict[str, Any]):
+        async with semaphore:
+            await self.definitions.create_item(document)
+        await self._adjust_count(1)
+
+    async def update_definition(self, definition: Definition, etag: Optional[str] = None):
+        definition.id = definition.word.lower()
+        if etag:
+            await self.definitions.replace_item(definition.id, self._to_document(definition), etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            await self.definitions.replace_item(definition.id, self._to_document(definition))
+        await self._invalidate()
+
+    def _to_definition(self, item: Dict[str, Any]) -> Definition:
+        fields = dict(item)
+        fields["author"] = Author.model_construct(**item["author"])
+        if item.get("created_date"):
+            fields["created_date"] = datetime.fromisoformat(item["created_date"])
+        fields["etag"] = item.get("_etag")
+        return Definition.model_construct(**fields)
 
-    async def update_definition(self, definition: Definition):
-        self.definitions.replace_item(definition.id, definition.dict(), partition_key=definition.word)
+    def _to_document(self, definition: Definition) -> Dict[str, Any]:
+        definition_dict = definition.model_dump(mode="json", exclude_none=True)
+        definition_dict["word_lc"] = definition.word.lower()
+        definition_dict["tag_lc"] = definition.tag.lower()
+        definition_dict["random_key"] = zlib.crc32(definition.id.encode())
+        return definition_dict
 
     async def get_definitions_by_search(self, search_term: str, page_size: int = 10, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
-        query = """
-        SELECT * FROM d WHERE 
-        LOWER(d.word) LIKE @search OR
-        LOWER(d.content) LIKE @search OR
-        LOWER(d.author.name) LIKE @search OR
-        LOWER(d.tag) LIKE @search OR
-        LOWER(d.abbreviation) LIKE @search
-        """
-        params = [{"name": "@search", "value": f"%{search_term.lower()}%"}]
-        return await self._query_with_paging(query, page_size, continuation_token, params)
+        search_term = re.sub(r"\s+", " ", search_term.strip().lower())
+        if self.redis is None:
+            return await self._search(search_term, page_size, continuation_token)
+
+        try:
+            generation = int(await self.redis.get(SEARCH_GENERATION_KEY) or 0)
+            key = SEARCH_CACHE_PREFIX + hashlib.blake2b(repr((generation, search_term, page_size, continuation_token)).encode(), digest_size=16).hexdigest()
+            cached = await self.redis.get(key)
+        except RedisError:
+            logger.warning("Redis read failed, searching Cosmos DB directly", exc_info=True)
+            return await self._search(search_term, page_size, continuation_token)
+        if cached is not None:
+            results, token = orjson.loads(cached)
+            return results, token
+        results, token = await self._search(search_term, page_size, continuation_token)
+        try:
+            await self.redis.set(key, orjson.dumps([results, token]), ex=SEARCH_CACHE_TTL)
+        except RedisError:
+            logger.warning("Redis write failed, search page not cached", exc_info=True)
+        return results, token
+
+    async def _search(self, search_term: str, page_size: int = 10, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
+        if not self.full_text_search:
+            return await self._get_definitions_by_like(search_term, page_size, continuation_token)
+        params = [{"name": "@term", "value": search_term}]
+        return await self._query_with_paging(QUERY_FULL_TEXT, page_size, continuation_token, params, use_local_cache=self.redis is None)
+
+    async def _get_definitions_by_like(self, search_term: str, page_size: int = 10, continuation_token: Optional[str] = None) -> Tuple[List[Definition], Optional[str]]:
+        params = [{"name": "@search", "value": f"%{search_term}%"}]
+        return await self._query_with_paging(QUERY_LIKE, page_size, continuation_token, params, use_local_cache=self.redis is None)
 
     async def get_random_definition(self) -> Optional[Definition]:
-        count = await self.get_definition_count()
-        if count == 0:
-            return None
-        skip = random.randint(0, count - 1)
-        query = f"SELECT * FROM c OFFSET {skip} LIMIT 1"
-        results = list(self.definitions.query_items(query))
-        return Definition(**results[0]) if results else None
+        for start in (random.randrange(RANDOM_KEY_SPACE), 0):
+            params = [{"name": "@start", "value": start}]
+            results = [item async for item in self.definitions.query_items(QUERY_RANDOM, parameters=params)]
+            if results:
+                return self._to_definition(results[0])
+        return None
 
     async def get_definition_count(self) -> int:
-        query = "SELECT VALUE COUNT(1) FROM c"
-        return list(self.definitions.query_items(query))[0]
-
-    async def _query_with_paging(self, query: str, page_size: int, continuation_token: Optional[str] = None, params: List[Dict] = None) -> Tuple[List[Any], Optional[str]]:
-        options = {
-            "max_item_count": page_size,
-            "continuation_token": continuation_token
-        }
-        
-        results = []
-        query_iterator = self.definitions.query_items(
+        if self.redis is not None:
+            try:
+                count = await self.redis.get(COUNT_KEY)
+            except RedisError:
+                logger.warning("Redis read failed, counting definitions in Cosmos DB", exc_info=True)
+            else:
+                if count is not None:
+                    return int(count)
+                return await self.reconcile_definition_count()
+        key = self._cache_key(QUERY_COUNT)
+        count = self.cache.get(key)
+        if count is None:
+            generation = self._generation
+            results = [item async for item in self.definitions.query_items(QUERY_COUNT)]
+            count = results[0]
+            if generation == self._generation:
+                self.cache[key] = count
+        return count
+
+    async def reconcile_definition_count(self) -> int:
+        results = [item async for item in self.definitions.query_items(QUERY_COUNT)]
+        if self.redis is not None:
+            try:
+                await self.redis.set(COUNT_KEY, results[0], ex=COUNT_RECONCILE_SECONDS)
+            except RedisError:
+                logger.warning("Redis write failed, definition count not stored", exc_info=True)
+        return results[0]
+
+    async def _adjust_count(self, amount: int):
+        if self._adjust_count_script is None:
+            return
+        try:
+            await self._adjust_count_script(keys=[COUNT_KEY], args=[amount])
+        except RedisError:
+            logger.warning("Redis counter update failed, definition count may drift until reconciled", exc_info=True)
+
+    async def _invalidate(self):
+        self._generation += 1
+        self.cache.clear()
+        self._inflight.clear()
+        if self.redis is None:
+            return
+        try:
+            await self.redis.incr(SEARCH_GENERATION_KEY)
+        except RedisError:
+            logger.warning("Redis search cache invalidation failed", exc_info=True)
+
+    def _cache_key(self, query: str, params: List[Dict] = None, *parts: Any) -> bytes:
+        return hashlib.blake2b((query + repr(params) + repr(parts)).encode()).digest()
+
+    async def _query_with_paging(self, query: str, page_size: int, continuation_token: Optional[str] = None, params: List[Dict] = None, use_local_cache: bool = True) -> Tuple[List[Any], Optional[str]]:
+        page_size = max(1, min(page_size, self.max_page_size))
+        key = self._cache_key(query, params, page_size, continuation_token)
+        if use_local_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        generation = self._generation
+        pages = self.definitions.query_items(
             query=query,
             parameters=params,
-            enable_cross_partition_query=True
-        )
-        
-        for item in query_iterator:
-            results.append(item)
-            if len(results) >= page_size:
-                break
-                
-        return results, getattr(query_iterator, '_continuation_token', None)
\ No newline at end of file
+            max_item_count=page_size,
+            continuation_token_limit=1
+        ).by_page(self._decode_token(continuation_token))
+
+        try:
+            page = await pages.__anext__()
+        except StopAsyncIteration:
+            return [], None
+        results = [item async for item in page]
+
+        page = (results, self._encode_token(pages.continuation_token))
+        if use_local_cache and generation == self._generation:
+            self.cache[key] = page
+        return page
+
+    def _encode_token(self, token: Optional[str]) -> Optional[str]:
+        if not token:
+            return None
+        return base64.urlsafe_b64encode(zlib.compress(token.encode())).decode()
+
+    def _decode_token(self, token: Optional[str]) -> Optional[str]:
+        if not token:
+            return None
+        try:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(base64.urlsafe_b64decode(token.encode()), MAX_TOKEN_BYTES)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError("continuation token exceeds size limit")
+            return data.decode()
+        except (binascii.Error, zlib.error, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid continuation token")
@@ -1,102 +1,203 @@
-from fastapi import FastAPI, Depends, Query, HTTPException
-from fastapi.responses import RedirectResponse
-from dotenv import load_dotenv
+from fastapi import FastAPI, Depends, Query, HTTPException, Request, Response, Header
+from fastapi.responses import RedirectResponse, ORJSONResponse
+from pydantic_settings import BaseSettings, SettingsConfigDict
 import logging
-import os
-from azure.cosmos import CosmosClient
-from azure.cosmos.database import DatabaseProxy
-from definitions_repository import Definition, PaginatedResponse, DefinitionsRepository
-from typing import Optional
+import hashlib
+import math
+import aiohttp
+from azure.cosmos.aio import CosmosClient
+from azure.core.pipeline.transport import AioHttpTransport
+from redis.asyncio import Redis
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceExistsError, CosmosResourceNotFoundError, CosmosAccessConditionFailedError
+from definitions_repository import Definition, PaginatedResponse, DefinitionsRepository, create_definitions_container
+from typing import Optional, List, Dict, Any
 
-load_dotenv()
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
-app = FastAPI()
+    azure_cosmos_endpoint: str
+    azure_cosmos_key: str
+    azure_cosmos_database_name: str
+    azure_cosmos_container_name: str
+    azure_cosmos_full_text_search: bool = True
+    azure_cosmos_preferred_regions: Optional[str] = None
+    redis_url: Optional[str] = None
+
+settings = Settings()
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("dictionary")
 
-def get_cosmos_client() -> CosmosClient:
-    return CosmosClient(os.getenv("AZURE_COSMOS_ENDPOINT"), os.getenv("AZURE_COSMOS_KEY"))
+@app.on_event("startup")
+async def startup():
+    connector = aiohttp.TCPConnector(limit=512, limit_per_host=128, keepalive_timeout=300, enable_cleanup_closed=True)
+    app.state.http_session = aiohttp.ClientSession(connector=connector)
+    preferred_regions = settings.azure_cosmos_preferred_regions
+    app.state.cosmos_client = CosmosClient(
+        settings.azure_cosmos_endpoint,
+        settings.azure_cosmos_key,
+        transport=AioHttpTransport(session=app.state.http_session, session_owner=False),
+        enable_endpoint_discovery=True,
+        preferred_locations=preferred_regions.split(",") if preferred_regions else None
+    )
+    app.state.cosmos_db = app.state.cosmos_client.get_database_client(settings.azure_cosmos_database_name)
+    await create_definitions_container(app.state.cosmos_db, settings.azure_cosmos_container_name)
+    app.state.redis = Redis.from_url(settings.redis_url) if settings.redis_url else None
+    app.state.repo = DefinitionsRepository(
+        app.state.cosmos_db,
+        settings.azure_cosmos_container_name,
+        settings.azure_cosmos_full_text_search,
+        app.state.redis
+    )
 
-def get_cosmos_database(client: CosmosClient = Depends(get_cosmos_client)) -> DatabaseProxy:
-    return client.get_database_client(os.getenv("AZURE_COSMOS_DATABASE_NAME"))
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.cosmos_client.close()
+    await app.state.http_session.close()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+@app.exception_handler(CosmosHttpResponseError)
+async def cosmos_error_handler(request: Request, err: CosmosHttpResponseError):
+    if err.status_code == 429:
+        retry_after_ms = float((err.headers or {}).get("x-ms-retry-after-ms", 1000))
+        return Response(status_code=429, headers={"Retry-After": str(math.ceil(retry_after_ms / 1000))})
+    logger.error("Cosmos DB request failed with status %s: %s", err.status_code, err.message)
+    return ORJSONResponse({"detail": "Cosmos DB request failed"}, status_code=500)
+
+def get_repository(request: Request) -> DefinitionsRepository:
+    return request.app.state.repo
+
+def page_etag(definitions: List[Dict[str, Any]], continuation_token: Optional[str]) -> str:
+    etags = "".join(definition.get("_etag", "") for definition in definitions)
+    return '"' + hashlib.blake2b(((continuation_token or "") + etags).encode(), digest_size=16).hexdigest() + '"'
+
+def page_response(response: Response, definitions: List[Dict[str, Any]], continuation_token: Optional[str]) -> ORJSONResponse:
+    return ORJSONResponse({"data": definitions, "continuation_token": continuation_token}, headers=dict(response.headers))
+
+def not_modified(request: Request, response: Response, etag: Optional[str]) -> bool:
+    if not etag:
+        return False
+    response.headers["ETag"] = etag
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
-def get_repository(database: DatabaseProxy = Depends(get_cosmos_database)) -> DefinitionsRepository:
-    return DefinitionsRepository(
-        database,
-        os.getenv("AZURE_COSMOS_CONTAINER_NAME")
-    )
-    
 @app.get("/", include_in_schema=False)
 async def root():
     return RedirectResponse(url="/docs")
 
 @app.get("/definitions", response_model=PaginatedResponse)
 async def get_all_definitions(
-    page_size: int = Query(10, le=50),
+    request: Request,
+    response: Response,
+    page_size: int = Query(10, ge=1, le=50),
     continuation_token: Optional[str] = None,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
     definitions, token = await repo.get_all_definitions(page_size, continuation_token)
     if not definitions:
         raise HTTPException(status_code=404, detail="No definitions found")
-    return PaginatedResponse(data=definitions, continuation_token=token)
+    response.headers["Cache-Control"] = "public, max-age=60"
+    if not_modified(request, response, page_etag(definitions, token)):
+        return Response(status_code=304, headers=dict(response.headers))
+    return page_response(response, definitions, token)
 
 @app.get("/definitions/{id}")
 async def get_definition_by_id(
     id: str,
     word: str,
+    request: Request,
+    response: Response,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
     definition = await repo.get_definition_by_id(id, word)
     if not definition:
         raise HTTPException(status_code=404, detail=f"Definition with ID {id} not found")
+    if not_modified(request, response, definition.etag):
+        return Response(status_code=304, headers=dict(response.headers))
     return definition
 
 @app.get("/definitions/word/{word}")
 async def get_definition_by_word(
     word: str,
+    request: Request,
+    response: Response,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
     definition = await repo.get_definition_by_word(word)
     if not definition:
         raise HTTPException(status_code=404, detail=f"Definition for word '{word}' not found")
+    if not_modified(request, response, definition.etag):
+        return Response(status_code=304, headers=dict(response.headers))
     return definition
 
 
 @app.get("/definitions/tag/{tag}", response_model=PaginatedResponse)
 async def get_definitions_by_tag(
     tag: str,
-    page_size: int = Query(5, le=50),
+    request: Request,
+    response: Response,
+    page_size: int = Query(5, ge=1, le=50),
     continuation_token: Optional[str] = None,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
     definitions, token = await repo.get_definitions_by_tag(tag, page_size, continuation_token)
     if not definitions:
         raise HTTPException(status_code=404, detail=f"No definitions found for tag '{tag}'")
-    return PaginatedResponse(data=definitions, continuation_token=token)
+    response.headers["Cache-Control"] = "public, max-age=60"
+    if not_modified(request, response, page_etag(definitions, token)):
+        return Response(status_code=304, headers=dict(response.headers))
+    return page_response(response, definitions, token)
+
+@app.get("/definitions/prefix/{prefix}", response_model=PaginatedResponse)
+async def get_definitions_by_prefix(
+    prefix: str,
+    request: Request,
+    response: Response,
+    page_size: int = Query(10, ge=1, le=50),
+    continuation_token: Optional[str] = None,
+    repo: DefinitionsRepository = Depends(get_repository)
+):
+    definitions, token = await repo.get_definitions_by_prefix(prefix, page_size, continuation_token)
+    if not definitions:
+        raise HTTPException(status_code=404, detail=f"No definitions found for prefix '{prefix}'")
+    if not_modified(request, response, page_etag(definitions, token)):
+        return Response(status_code=304, headers=dict(response.headers))
+    return page_response(response, definitions, token)
 
 @app.get("/definitions/search/{term}", response_model=PaginatedResponse)
 async def search_definitions(
     term: str,
-    page_size: int = Query(10, le=50),
+    request: Request,
+    response: Response,
+    page_size: int = Query(10, ge=1, le=50),
     continuation_token: Optional[str] = None,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
     definitions, token = await repo.get_definitions_by_search(term, page_size, continuation_token)
     if not definitions:
         raise HTTPException(status_code=404, detail=f"No definitions found for search term '{term}'")
-    return PaginatedResponse(data=definitions, continuation_token=token)
+    if not_modified(request, response, page_etag(definitions, token)):
+        return Response(status_code=304, headers=dict(response.headers))
+    return page_response(response, definitions, token)
 
 @app.delete("/definitions/{word}")
 async def delete_definition(
     word: str,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
-    definition = await repo.get_definition_by_word(word)
-    if not definition:
+    try:
+        await repo.delete_definition(word)
+    except CosmosResourceNotFoundError:
         raise HTTPException(status_code=404, detail=f"Definition for word '{word}' not found")
-    await repo.delete_definition(definition)
     return {"status": "deleted"}
 
 @app.post("/definitions", status_code=201)
@@ -104,20 +205,25 @@ async def create_definition(
     definition: Definition,
     repo: DefinitionsRepository = Depends(get_repository)
 ):
-    existing = await repo.get_definition_by_word(definition.word)
-    if existing:
+    try:
+        await repo.add_definition(definition)
+    except CosmosResourceExistsError:
         raise HTTPException(status_code=409, detail=f"Definition for word '{definition.word}' already exists")
-    await repo.add_definition(definition)
     return definition
 
 @app.put("/definitions/{word}")
 async def update_definition(
     word: str,
     definition: Definition,
+    if_match: Optional[str] = Header(None),
     repo: DefinitionsRepository = Depends(get_repository)
 ):
-    existing = await repo.get_definition_by_word(word)
-    if not existing:
+    if word.lower() != definition.word.lower():
+        raise HTTPException(status_code=400, detail=f"Body word '{definition.word}' does not match path word '{word}'")
+    try:
+        await repo.update_definition(definition, if_match)
+    except CosmosResourceNotFoundError:
         raise HTTPException(status_code=404, detail=f"Definition for word '{word}' not found")
-    await repo.update_definition(definition)
-    return definition
\ No newline at end of file
+    except CosmosAccessConditionFailedError:
+        raise HTTPException(status_code=409, detail=f"Definition for word '{word}' was modified")
+    return definition